@@ -1,2 +1 @@
 __version__ = "1.0.0"
-default_app_config = 'eventyay-paypal.apps.PaypalPluginApp'
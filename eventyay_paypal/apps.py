@@ -1,4 +1,3 @@
-from django.apps import AppConfig
 from django.utils.translation import gettext_lazy as _
 
 from . import __version__
@@ -9,7 +8,7 @@ except ImportError:
     raise RuntimeError("Python package 'paypal' is not installed.")
 
 
-class PaypalPluginApp(AppConfig):
+class PaypalPluginApp(PluginConfig):
     default = True
     name = "eventyay_paypal"
     verbose_name = _("PayPal")
@@ -25,6 +24,3 @@ class PaypalPluginApp(AppConfig):
 
     def ready(self):
         from . import signals  # NOQA
-
-
-default_app_config = "eventyay-paypal.apps.PaypalPluginApp"
@@ -0,0 +1,70 @@
+import logging
+
+from django.db import DatabaseError, migrations
+
+logger = logging.getLogger("pretix.plugins.eventyay_paypal")
+
+INDEX_NAME = "eventyay_paypal_op_info_trgm"
+
+
+def ensure_trgm_extension(schema_editor):
+    """
+    Creating pg_trgm needs CREATE rights on the database, which the application role
+    may lack. The index is optional, so it is skipped instead of aborting the
+    migration; see the README for creating the extension manually.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone():
+            return True
+    try:
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError as e:
+        logger.warning(
+            "Unable to create the pg_trgm extension, skipping the index on "
+            "OrderPayment.info: %s",
+            e,
+        )
+        return False
+    return True
+
+
+def create_index(apps, schema_editor):
+    # OrderPayment.info is a text column, a trigram index lets PostgreSQL answer
+    # the substring lookup of the webhook without scanning all payments
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    if not ensure_trgm_extension(schema_editor):
+        return
+    OrderPayment = apps.get_model("pretixbase", "OrderPayment")
+    schema_editor.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {table} "
+        "USING gin (info gin_trgm_ops) WHERE provider = 'paypal'".format(
+            index=schema_editor.quote_name(INDEX_NAME),
+            table=schema_editor.quote_name(OrderPayment._meta.db_table),
+        )
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        "DROP INDEX CONCURRENTLY IF EXISTS {index}".format(
+            index=schema_editor.quote_name(INDEX_NAME),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('eventyay_paypal', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
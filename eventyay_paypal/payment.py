@@ -501,12 +501,12 @@ class Paypal(BasePaymentProvider):
         if (
             str(
                 safe_get(
-                    order_detail.get("purchase_units", [{}])[0], ["amount", "value"]
+                    order_detail.get("purchase_units", [{}])[0], ("amount", "value")
                 )
             )
             != str(payment.amount)
             or safe_get(
-                order_detail.get("purchase_units", [{}])[0], ["amount", "currency_code"]
+                order_detail.get("purchase_units", [{}])[0], ("amount", "currency_code")
             )
             != self.event.currency
         ):
@@ -567,7 +567,7 @@ class Paypal(BasePaymentProvider):
 
             captured_order = capture_response.get("response")
             for purchase_unit in captured_order.get("purchase_units", []):
-                for capture in safe_get(purchase_unit, ["payments", "captures"], []):
+                for capture in safe_get(purchase_unit, ("payments", "captures"), []):
                     with contextlib.suppress(
                         ReferencedPayPalObject.MultipleObjectsReturned
                     ):
@@ -623,7 +623,7 @@ class Paypal(BasePaymentProvider):
                 payment.info
                 and safe_get(
                     payment.info_data.get("purchase_units", [{}])[0],
-                    ["payments", "captures", "status"],
+                    ("payments", "captures", "status"),
                 )
                 == "pending"
             ):
@@ -641,7 +641,7 @@ class Paypal(BasePaymentProvider):
     def matching_id(self, payment: OrderPayment):
         order_id = None
         for trans in payment.info_data.get("purchase_units", []):
-            for res in safe_get(trans, ["payments", "captures"], []):
+            for res in safe_get(trans, ("payments", "captures"), []):
                 order_id = res.get("id")
                 break
         return order_id or payment.info_data.get("id", None)
@@ -650,10 +650,10 @@ class Paypal(BasePaymentProvider):
         order_id = self.matching_id(payment)
         return {
             "payer_email": safe_get(
-                payment.info_data, ["payer", "payer_info", "email"]
+                payment.info_data, ("payer", "payer_info", "email")
             ),
             "payer_id": safe_get(
-                payment.info_data, ["payer", "payer_info", "payer_id"]
+                payment.info_data, ("payer", "payer_info", "payer_id")
             ),
             "cart_id": payment.info_data.get("cart", None),
             "payment_id": payment.info_data.get("id", None),
@@ -674,7 +674,7 @@ class Paypal(BasePaymentProvider):
         return template.render(ctx)
 
     def payment_control_render_short(self, payment: OrderPayment) -> str:
-        return safe_get(payment.info_data, ["payer", "payer_info", "email"], "")
+        return safe_get(payment.info_data, ("payer", "payer_info", "email"), "")
 
     def payment_partial_refund_supported(self, payment: OrderPayment):
         # Paypal refunds are possible for 180 days after purchase:
@@ -692,7 +692,7 @@ class Paypal(BasePaymentProvider):
                 capture.get("id")
                 for capture in safe_get(
                     payment_info_data.get("purchase_units", [{}])[0],
-                    ["payments", "captures"],
+                    ("payments", "captures"),
                     [],
                 )
                 if capture.get("status") in ["COMPLETED", "PARTIALLY_REFUNDED"]
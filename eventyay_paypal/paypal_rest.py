@@ -1,22 +1,48 @@
 import base64
+import binascii
 import hashlib
 import json
 import logging
 import time
 import urllib.parse
 import uuid
+import warnings
+import zlib
+from datetime import datetime, timezone
 from http import HTTPMethod
+from http.cookiejar import DefaultCookiePolicy
 from typing import List, Optional
 
+import certifi
 import jwt
 import requests
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.utils import CryptographyDeprecationWarning
+from cryptography.x509.oid import NameOID
 from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger("pretix.plugins.eventyay_paypal")
 
 
 class PaypalRequestHandler:
+    # Shared by all instances of a process so connections to PayPal are reused,
+    # created on first use so forked workers don't inherit the parent's pool
+    _session = None
+    # Root certificates webhook certificate chains must end in, loaded on first use
+    _trusted_roots = None
+
+    # Subjects of the certificates Paypal signs webhooks with
+    webhook_certificate_names = (
+        "messageverificationcerts.paypal.com",
+        "messageverificationcerts.sandbox.paypal.com",
+    )
+
     def __init__(self, settings):
         # settings contain client_id and secret_key
         self.settings = settings
@@ -75,18 +101,19 @@ class PaypalRequestHandler:
 
         reason = ""
         response_data = {}
+        session = self.get_session()
         try:
             if method == HTTPMethod.GET:
-                response = requests.get(
+                response = session.get(
                     url, data=data, params=params, headers=headers, timeout=timeout
                 )
             elif method == HTTPMethod.POST:
-                response = requests.post(
+                response = session.post(
                     url, data=data, params=params, headers=headers, timeout=timeout
                 )
             elif method == HTTPMethod.PATCH:
                 # Patch request return empty body
-                requests.patch(
+                session.patch(
                     url, data=data, params=params, headers=headers, timeout=timeout
                 )
                 return {}
@@ -120,6 +147,32 @@ class PaypalRequestHandler:
             }
             return response_data
 
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """
+        Returns the HTTP session used for all requests to Paypal.
+        All requests are retried on connection errors, POST and PATCH requests are
+        not retried on read errors or gateway status codes.
+        Cookies are rejected, the session is shared by all merchants and events.
+        """
+        if cls._session is None:
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount(
+                "https://",
+                HTTPAdapter(
+                    pool_connections=10,
+                    pool_maxsize=20,
+                    max_retries=Retry(
+                        total=3,
+                        backoff_factor=0.3,
+                        status_forcelist=[502, 503, 504],
+                    ),
+                ),
+            )
+            cls._session = session
+        return cls._session
+
     @staticmethod
     def check_expired_token(access_token_data: dict, buffer_time: int = 300) -> bool:
         current_time = time.time()
@@ -321,10 +374,190 @@ class PaypalRequestHandler:
             data=json.dumps(refund_data),
         )
 
-    def verify_webhook_signature(self, data: dict) -> dict:
+    @staticmethod
+    def is_paypal_cert_url(cert_url: str) -> bool:
+        """
+        Only certificates served by Paypal over https are accepted, so webhooks
+        can't make us fetch arbitrary urls or poison the certificate cache
+        """
+        parsed_url = urllib.parse.urlsplit(cert_url or "")
+        hostname = parsed_url.hostname or ""
+        return parsed_url.scheme == "https" and (
+            hostname == "paypal.com" or hostname.endswith(".paypal.com")
+        )
+
+    def get_webhook_certificate(self, cert_url: str) -> Optional[bytes]:
+        """
+        https://developer.paypal.com/api/rest/webhooks/rest/#link-verifysignature
+        Get the PEM certificate Paypal signs webhooks with from cache,
+        certificates rotate rarely, so they are kept for 6 hours
+        """
+        if not self.is_paypal_cert_url(cert_url):
+            logger.error("Refusing to fetch Paypal certificate from %s", cert_url)
+            return None
+
+        cache_key = f"paypal_cert_{hashlib.sha256(cert_url.encode()).hexdigest()}"
+        certificate = cache.get(cache_key)
+        if certificate is None:
+            try:
+                response = self.get_session().get(cert_url, timeout=5)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                logger.error("Unable to fetch Paypal certificate %s: %s", cert_url, e)
+                return None
+            certificate = response.content
+            cache.set(cache_key, certificate, 3600 * 6)
+        return certificate
+
+    @classmethod
+    def get_trusted_roots(cls) -> List[x509.Certificate]:
+        """
+        Returns the root certificates of the CA bundle requests uses for TLS.
+        Certificates cryptography can't parse are skipped.
+        """
+        if cls._trusted_roots is None:
+            with open(certifi.where(), "rb") as f:
+                blocks = f.read().split(b"-----END CERTIFICATE-----")
+            roots = []
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", CryptographyDeprecationWarning)
+                for block in blocks:
+                    if b"-----BEGIN CERTIFICATE-----" not in block:
+                        continue
+                    try:
+                        roots.append(
+                            x509.load_pem_x509_certificate(
+                                block + b"-----END CERTIFICATE-----"
+                            )
+                        )
+                    except ValueError:
+                        continue
+            cls._trusted_roots = roots
+        return cls._trusted_roots
+
+    def is_valid_webhook_certificate_chain(self, chain: List[x509.Certificate]) -> bool:
+        """
+        Checks that the first certificate of the bundle served at cert_url belongs to Paypal's
+        message verification service, and that it chains through the other certificates of
+        the bundle to a trusted root. All certificates must be within their validity period.
+        """
+        leaf = chain[0]
+        names = [
+            attribute.value
+            for attribute in leaf.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        ]
+        if not any(name in self.webhook_certificate_names for name in names):
+            logger.error("Paypal certificate has unexpected subject %s", leaf.subject)
+            return False
+
+        current_time = datetime.now(timezone.utc)
+        for index, certificate in enumerate(chain):
+            if not (
+                certificate.not_valid_before_utc
+                <= current_time
+                <= certificate.not_valid_after_utc
+            ):
+                logger.error("Paypal certificate %s is not valid", certificate.subject)
+                return False
+
+            if index + 1 < len(chain):
+                if not self._is_ca(chain[index + 1]):
+                    logger.error(
+                        "Paypal certificate %s is not a CA", chain[index + 1].subject
+                    )
+                    return False
+                issuers = [chain[index + 1]]
+            else:
+                issuers = [
+                    root
+                    for root in self.get_trusted_roots()
+                    if root.subject == certificate.issuer
+                ]
+            if not any(
+                self._is_issued_by(certificate, issuer) for issuer in issuers
+            ):
+                logger.error(
+                    "Paypal certificate %s is not issued by a trusted certificate",
+                    certificate.subject,
+                )
+                return False
+        return True
+
+    @staticmethod
+    def _is_ca(certificate: x509.Certificate) -> bool:
+        try:
+            return certificate.extensions.get_extension_for_class(
+                x509.BasicConstraints
+            ).value.ca
+        except x509.ExtensionNotFound:
+            return False
+
+    @staticmethod
+    def _is_issued_by(certificate: x509.Certificate, issuer: x509.Certificate) -> bool:
+        try:
+            certificate.verify_directly_issued_by(issuer)
+        except (InvalidSignature, TypeError, ValueError):
+            return False
+        return True
+
+    def verify_webhook_signature_locally(self, data: dict, body: bytes) -> Optional[str]:
+        """
+        https://developer.paypal.com/api/rest/webhooks/rest/#link-verifysignature
+        Paypal signs transmission_id|transmission_time|webhook_id|crc32(body)
+        with the certificate at cert_url.
+        Returns the verification status, or None if the certificate or its chain
+        can't be used.
+        """
+        if data.get("auth_algo") != "SHA256withRSA":
+            return None
+
+        pem = self.get_webhook_certificate(data.get("cert_url"))
+        if pem is None:
+            return None
+        try:
+            chain = x509.load_pem_x509_certificates(pem)
+        except ValueError as e:
+            logger.error("Unable to load Paypal certificate: %s", e)
+            return None
+        if not self.is_valid_webhook_certificate_chain(chain):
+            return None
+
+        public_key = chain[0].public_key()
+        if not isinstance(public_key, rsa.RSAPublicKey):
+            return None
+
+        message = "|".join(
+            [
+                str(data.get("transmission_id")),
+                str(data.get("transmission_time")),
+                str(data.get("webhook_id")),
+                str(zlib.crc32(body)),
+            ]
+        )
+        try:
+            public_key.verify(
+                base64.b64decode(data.get("transmission_sig") or "", validate=True),
+                message.encode(),
+                padding.PKCS1v15(),
+                hashes.SHA256(),
+            )
+        except (InvalidSignature, binascii.Error):
+            return "FAILURE"
+        return "SUCCESS"
+
+    def verify_webhook_signature(
+        self, data: dict, body: Optional[bytes] = None
+    ) -> dict:
         """
         https://developer.paypal.com/docs/api/webhooks/v1/#verify-webhook-signature_post
+        If the raw body is given, the signature is verified locally. The verification
+        endpoint is only used if Paypal's certificate can't be used.
         """
+        if body is not None:
+            verification_status = self.verify_webhook_signature_locally(data, body)
+            if verification_status is not None:
+                return {"response": {"verification_status": verification_status}}
+
         return self.request(
             url=self.verify_webhook_url,
             method=HTTPMethod.POST,
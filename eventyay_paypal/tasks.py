@@ -0,0 +1,374 @@
+import contextlib
+import logging
+import os
+from decimal import Decimal
+
+import orjson
+from celery.utils.time import get_exponential_backoff_interval
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from pretix.base.models import OrderPayment, OrderRefund, Quota
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+from .models import ReferencedPayPalObject
+from .payment import Paypal
+from .utils import LazyJSON, cache_lock, safe_get
+
+logger = logging.getLogger("pretix.plugins.eventyay_paypal")
+
+
+class WebhookNotProcessed(Exception):
+    """
+    Raised if the PayPal order of a webhook can't be retrieved yet, e.g. because
+    PayPal was unreachable, so the task is retried instead of dropping the event
+    """
+
+
+# A lock left behind by a crashed worker expires after PAYMENT_LOCK_TIMEOUT, tasks
+# waiting for it retry every PAYMENT_LOCK_RETRY_DELAY seconds until then
+PAYMENT_LOCK_TIMEOUT = 300
+PAYMENT_LOCK_RETRY_DELAY = 5
+
+# Refund states counted towards the amount already refunded for a payment
+KNOWN_REFUND_STATES = (
+    OrderRefund.REFUND_STATE_DONE,
+    OrderRefund.REFUND_STATE_TRANSIT,
+    OrderRefund.REFUND_STATE_CREATED,
+    OrderRefund.REFUND_SOURCE_EXTERNAL,
+)
+
+
+def get_webhook_queue():
+    """
+    Returns the Celery queue webhook events are processed on, so operators can route
+    them to a dedicated worker pool. ``None`` keeps the default routing.
+    """
+    return (
+        getattr(settings, "PAYPAL_WEBHOOK_QUEUE", None)
+        or os.environ.get("EVENTYAY_PAYPAL_WEBHOOK_QUEUE")
+        or None
+    )
+
+
+def parse_webhook_event(event_json, event=None):
+    """
+    Parse the given webhook event and return the corresponding event, payment ID and RPO.
+
+    :param event_json: The json payload of the webhook
+    :param event: Optional. The event to fall back to if no RPO is found
+    :return: A tuple of (event, payment_id, referenced_paypal_object)
+    """
+    payment_id = None
+    if event_json["resource_type"] == "refund":
+        for link in event_json["resource"]["links"]:
+            if link["rel"] == "up":
+                refund_url = link["href"]
+                payment_id = refund_url.split("/")[-1]
+                break
+    else:
+        payment_id = event_json["resource"]["id"]
+
+    references = [payment_id]
+
+    # For filtering reference, there are a lot of ids appear within json__event
+    if ref_order_id := (
+        safe_get(
+            event_json,
+            ("resource", "supplementary_data", "related_ids", "order_id")
+        )
+    ):
+        references.append(ref_order_id)
+
+    # Grasp the corresponding RPO. The event and payment are used as a whole later
+    # on, of the order only the event reference is needed.
+    rpo = (
+        ReferencedPayPalObject.objects.select_related("order__event", "payment")
+        .only("reference", "order__event", "payment")
+        .filter(reference__in=references)
+        .first()
+    )
+
+    if rpo:
+        event = rpo.order.event
+        if "id" in rpo.payment.info_data:
+            payment_id = rpo.payment.info_data["id"]
+
+    return event, payment_id, rpo
+
+
+def has_settled_capture(info, capture_id):
+    """
+    Checks whether the serialized PayPal order of a payment contains a completed
+    or partially refunded capture with the given ID.
+
+    :param info: The raw ``info`` column of an ``OrderPayment``.
+    :param capture_id: The capture ID to look for.
+    """
+    purchase_units = (orjson.loads(info) if info else {}).get("purchase_units")
+    if not purchase_units:
+        return False
+    return any(
+        capture.get("status") in ("COMPLETED", "PARTIALLY_REFUNDED")
+        and capture.get("id") == capture_id
+        for capture in safe_get(purchase_units[0], ("payments", "captures"), [])
+    )
+
+
+def extract_order_and_payment(payment_id, event, event_json, prov, payment=None):
+    """
+    Extracts order details and associated payment information from PayPal webhook data.
+
+    :param payment_id: The ID of the payment to be extracted.
+    :param event: The event object associated with the payment.
+    :param event_json: The JSON payload of the webhook event.
+    :param prov: The payment provider instance.
+    :param payment: Optional. The payment already resolved through a referenced PayPal object.
+
+    :returns: A tuple containing the order details and the payment object.
+              Returns (None, None) if an error occurs while retrieving order details.
+    """
+    order_response = prov.paypal_request_handler.get_order(order_id=payment_id)
+    if errors := order_response.get("errors"):
+        logger.error("Paypal error on webhook: %s", errors["reason"])
+        logger.exception("PayPal error on webhook. Event data: %s", LazyJSON(event_json))
+        return None, None
+
+    order_detail = order_response.get("response")
+
+    if payment is None:
+        # Only load the info column of the candidates, the matching payment is
+        # fetched completely afterwards. PayPal IDs are stored verbatim, the case
+        # sensitive lookup can use the trigram index on info.
+        candidates = (
+            OrderPayment.objects.filter(
+                order__event=event,
+                provider="paypal",
+                info__contains=order_detail.get("id"),
+            )
+            .values_list("pk", "info")
+            .iterator(chunk_size=50)
+        )
+        payment_pk = next(
+            (
+                pk
+                for pk, info in candidates
+                if has_settled_capture(info, order_detail.get("id"))
+            ),
+            None,
+        )
+        if payment_pk is not None:
+            payment = OrderPayment.objects.select_related("order").get(pk=payment_pk)
+
+    return order_detail, payment
+
+
+def handle_refund(event, event_json, prov, payment):
+    refund_id_in_event = safe_get(event_json, ("resource", "id"))
+    refund_response = prov.paypal_request_handler.get_refund_detail(
+        refund_id=refund_id_in_event,
+        merchant_id=event.settings.payment_paypal_merchant_id,
+    )
+    if errors := refund_response.get("errors"):
+        logger.error("Paypal error on webhook: %s", errors["reason"])
+        logger.exception("PayPal error on webhook. Event data: %s", LazyJSON(event_json))
+        return
+
+    refund_detail = refund_response.get("response")
+    if refund_id := refund_detail.get("id"):
+        # Sum up the known refunds and look for refunds mentioning this refund ID
+        # in a single query
+        refunds = payment.refunds.aggregate(
+            known_sum=Sum("amount", filter=Q(state__in=KNOWN_REFUND_STATES)),
+            candidates=Count("id", filter=Q(info__contains=refund_id)),
+        )
+        known_sum = refunds["known_sum"] or Decimal("0.00")
+
+        known_refund = None
+        if refunds["candidates"]:
+            # The ID may also appear nested in another refund's info, so confirm the
+            # match on the parsed data
+            known_refund = next(
+                (
+                    refund
+                    for refund in payment.refunds.filter(info__contains=refund_id)
+                    if refund.info_data.get("id") == refund_id
+                ),
+                None,
+            )
+
+        if known_refund is None:
+            amount = abs(Decimal(safe_get(refund_detail, ("amount", "value"), "0.00")))
+            payment.create_external_refund(
+                amount=amount,
+                info=orjson.dumps(refund_detail).decode(),
+            )
+            known_sum += amount
+        elif (
+            known_refund.state
+            in (
+                OrderRefund.REFUND_STATE_CREATED,
+                OrderRefund.REFUND_STATE_TRANSIT,
+            )
+            and refund_detail.get("status", "") == "COMPLETED"
+        ):
+            known_refund.done()
+
+        seller_payable_breakdown_value = safe_get(
+            refund_detail,
+            ("seller_payable_breakdown", "total_refunded_amount", "value"),
+            "0.00",
+        )
+        total_refunded_amount = Decimal(seller_payable_breakdown_value)
+        if known_sum < total_refunded_amount:
+            payment.create_external_refund(amount=total_refunded_amount - known_sum)
+
+
+def handle_payment_state_confirmed(event, event_json, prov, order_detail, payment):
+    if event_json.get("resource_type") == "refund":
+        handle_refund(event, event_json, prov, payment)
+    elif order_detail.get("status") == "REFUNDED":
+        known_sum = payment.refunds.filter(
+            state__in=KNOWN_REFUND_STATES
+        ).aggregate(s=Sum("amount"))["s"] or Decimal("0.00")
+        if known_sum < payment.amount:
+            payment.create_external_refund(amount=payment.amount - known_sum)
+
+
+def handle_payment_state_pending(order_detail, payment):
+    if order_detail.get("status") == "APPROVED":
+        # Capturing needs the payer stored in the customer's session, which is only
+        # available once the customer returns to the shop (see views.success).
+        logger.info(
+            "PayPal order %s approved, awaiting capture on customer return",
+            payment.info_data.get("id"),
+        )
+    elif order_detail.get("status") == "COMPLETED":
+        captures = [
+            capture
+            for purchase_unit in order_detail.get("purchase_units", [])
+            for capture in safe_get(purchase_unit, ("payments", "captures"), [])
+        ]
+        # Store the references, the order details and the confirmation in a
+        # single transaction
+        with transaction.atomic():
+            # References are unique, captures that are already known are skipped
+            ReferencedPayPalObject.objects.bulk_create(
+                [
+                    ReferencedPayPalObject(
+                        order=payment.order,
+                        payment=payment,
+                        reference=capture["id"],
+                    )
+                    for capture in captures
+                    if capture.get("id")
+                ],
+                ignore_conflicts=True,
+            )
+            if captures and all(
+                capture.get("status") in ("COMPLETED", "REFUNDED", "PARTIALLY_REFUNDED")
+                for capture in captures
+            ):
+                with contextlib.suppress(Quota.QuotaExceededException):
+                    payment.info = orjson.dumps(order_detail).decode()
+                    payment.save(update_fields=["info"])
+                    payment.confirm()
+
+
+def handle_webhook_event(event, event_json, prov, order_detail, payment):
+    payment.refresh_from_db()
+    payment.order.log_action("pretix.plugins.eventyay_paypal.event", data=event_json)
+
+    if payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED and order_detail[
+        "status"
+    ] in ("PARTIALLY_REFUNDED", "REFUNDED", "COMPLETED"):
+        handle_payment_state_confirmed(event, event_json, prov, order_detail, payment)
+    elif payment.state in (
+        OrderPayment.PAYMENT_STATE_PENDING,
+        OrderPayment.PAYMENT_STATE_CREATED,
+        OrderPayment.PAYMENT_STATE_CANCELED,
+        OrderPayment.PAYMENT_STATE_FAILED,
+    ):
+        handle_payment_state_pending(order_detail, payment)
+
+
+@app.task(base=EventTask, bind=True, max_retries=5)
+def process_paypal_webhook(
+    self, event, event_json, payment_id, payment_pk, error_retries=0, lock_retries=0
+):
+    """
+    https://developer.paypal.com/api/rest/webhooks/event-names/
+    Processes a webhook event whose signature has already been verified by the view.
+    The view passes the payment ID and the pk of the payment it resolved through
+    parse_webhook_event (or None), so the referenced object isn't looked up twice.
+
+    Failed order fetches and waits for the payment lock are counted separately in
+    error_retries and lock_retries, so waiting doesn't use up the retries for errors.
+    """
+    prov = Paypal(event)
+    order_detail = payment = None
+    acquired = True
+
+    if payment_pk is None:
+        # Without a referenced object the payment can only be found through the
+        # PayPal order, so the order has to be fetched before locking the payment
+        order_detail, payment = extract_order_and_payment(
+            payment_id, event, event_json, prov
+        )
+        payment_pk = payment.pk if payment else None
+
+    if payment_pk is not None:
+        # PayPal delivers several events for the same order within seconds, only one
+        # worker at a time may create refunds or confirm a given payment
+        with cache_lock(
+            f"paypal:payment:{payment_pk}", timeout=PAYMENT_LOCK_TIMEOUT
+        ) as acquired:
+            if acquired:
+                if order_detail is None:
+                    payment = (
+                        OrderPayment.objects.select_related("order")
+                        .filter(pk=payment_pk)
+                        .first()
+                    )
+                    order_detail, payment = extract_order_and_payment(
+                        payment_id, event, event_json, prov, payment
+                    )
+                if order_detail is not None and payment is not None:
+                    handle_webhook_event(event, event_json, prov, order_detail, payment)
+
+    # Retries are raised outside of the lock, eager tasks would run into it otherwise.
+    # They pass on payment_pk, so a payment found through the order is locked first.
+    if not acquired:
+        if lock_retries >= PAYMENT_LOCK_TIMEOUT // PAYMENT_LOCK_RETRY_DELAY:
+            logger.error(
+                "Payment %s still locked, giving up on webhook for PayPal order %s",
+                payment_pk,
+                payment_id,
+            )
+            return
+        raise self.retry(
+            args=(event.pk, event_json, payment_id, payment_pk),
+            kwargs={"error_retries": error_retries, "lock_retries": lock_retries + 1},
+            countdown=PAYMENT_LOCK_RETRY_DELAY,
+            max_retries=None,
+        )
+    elif order_detail is None:
+        if error_retries >= self.max_retries:
+            logger.error("Unable to retrieve PayPal order %s, giving up", payment_id)
+            return
+        raise self.retry(
+            args=(event.pk, event_json, payment_id, payment_pk),
+            kwargs={"error_retries": error_retries + 1, "lock_retries": lock_retries},
+            countdown=get_exponential_backoff_interval(
+                factor=1, retries=error_retries, maximum=600, full_jitter=True
+            ),
+            max_retries=None,
+            exc=WebhookNotProcessed(f"Unable to retrieve PayPal order {payment_id}"),
+        )
+    elif payment is None:
+        # PayPal knows the order but none of our payments refers to it, retrying
+        # won't change that
+        logger.info(
+            "No payment found for PayPal order %s, ignoring webhook", payment_id
+        )
@@ -1,22 +1,59 @@
+from contextlib import contextmanager
+
+import orjson
+from django.core.cache import cache
+
 
 def safe_get(data, keys, default=None):
     """
-    Recursively calls .get() on a dictionary to safely access nested keys.
+    Calls .get() on nested dictionaries to safely access nested keys.
 
     Args:
         data (dict): The dictionary to access.
-        keys (list): The list of keys to access, in order.
+        keys (tuple): The keys to access, in order.
         default: The value to return if any key is missing or not a dictionary.
 
     Returns:
         The value at the accessed key, or the default value if any key is missing or not a dictionary.
     """
-    if not keys:
-        return data
-    key = keys[0]
-    value = data.get(key)
-    if not keys[1:]:
-        return value if value is not None else default
-    if isinstance(value, dict):
-        return safe_get(value, keys[1:], default=default)
-    return default
+    value = data
+    for key in keys:
+        if not isinstance(value, dict):
+            return default
+        value = value.get(key)
+    return value if value is not None else default
+
+
+@contextmanager
+def cache_lock(key, timeout=300):
+    """
+    Acquires a lock shared by all workers through the Django cache.
+
+    Args:
+        key (str): The cache key identifying the locked resource.
+        timeout (int): Seconds after which a lock left behind by a crashed worker expires.
+
+    Yields:
+        True if the lock was acquired, False if another worker currently holds it.
+    """
+    acquired = cache.add(key, "1", timeout=timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(key)
+
+
+class LazyJSON:
+    """
+    Wraps data passed as a logging argument, so it is only serialized to JSON
+    if a handler actually emits the record.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return orjson.dumps(self.data).decode()
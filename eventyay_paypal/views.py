@@ -1,13 +1,10 @@
-import contextlib
-import json
 import logging
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal
 from http import HTTPStatus
 
+import orjson
 from django.contrib import messages
 from django.core import signing
-from django.db.models import Sum
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
@@ -16,23 +13,52 @@ from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django_scopes import scopes_disabled
-from pretix.base.models import Event, Order, OrderPayment, OrderRefund, Quota
+from pretix.base.models import Event, Order, OrderPayment
 from pretix.base.payment import PaymentException
 from pretix.control.permissions import event_permission_required
 from pretix.multidomain.urlreverse import eventreverse
 
-from .models import ReferencedPayPalObject
 from .payment import Paypal
+from .tasks import get_webhook_queue, parse_webhook_event, process_paypal_webhook
 from .utils import safe_get
 
 logger = logging.getLogger("pretix.plugins.eventyay_paypal")
 
+_SAFE_REDIRECT_SIGNER = signing.Signer(salt="safe-redirect")
+
+_REQUIRED_OAUTH_PARAMS = frozenset(
+    {
+        "merchantId",
+        "merchantIdInPayPal",
+        "permissionsGranted",
+        "consentStatus",
+        "isEmailConfirmed",
+    }
+)
+_REQUIRED_OAUTH_SESSION_PARAMS = frozenset(
+    {
+        "payment_paypal_oauth_event",
+        "payment_paypal_tracking_id",
+    }
+)
+# PayPal webhook payloads stay well below this size
+_MAX_WEBHOOK_BODY_SIZE = 64 * 1024
+# As request.META keys, so the check is a plain set comparison
+_REQUIRED_WEBHOOK_HEADERS = frozenset(
+    {
+        "HTTP_PAYPAL_AUTH_ALGO",
+        "HTTP_PAYPAL_CERT_URL",
+        "HTTP_PAYPAL_TRANSMISSION_ID",
+        "HTTP_PAYPAL_TRANSMISSION_SIG",
+        "HTTP_PAYPAL_TRANSMISSION_TIME",
+    }
+)
+
 
 @xframe_options_exempt
 def redirect_view(request, *args, **kwargs):
-    signer = signing.Signer(salt="safe-redirect")
     try:
-        url = signer.unsign(request.GET.get("url", ""))
+        url = _SAFE_REDIRECT_SIGNER.unsign(request.GET.get("url", ""))
     except signing.BadSignature:
         return HttpResponseBadRequest("Invalid parameter")
 
@@ -53,29 +79,18 @@ def oauth_return(request, *args, **kwargs):
     https://developer.paypal.com/docs/multiparty/seller-onboarding/before-payment/
     Reference for seller onboarding
     """
-    required_params = [
-        "merchantId",
-        "merchantIdInPayPal",
-        "permissionsGranted",
-        "consentStatus",
-        "isEmailConfirmed",
-    ]
-    required_session_params = [
-        "payment_paypal_oauth_event",
-        "payment_paypal_tracking_id",
-    ]
-    if any(p not in request.session for p in required_session_params) or any(
-        p not in request.GET for p in required_params
-    ):
+    if not _REQUIRED_OAUTH_SESSION_PARAMS.issubset(
+        request.session.keys()
+    ) or not _REQUIRED_OAUTH_PARAMS.issubset(request.GET):
         messages.error(
             request,
             _("An error occurred during connecting with PayPal, please try again."),
         )
         return redirect(reverse("control:index"))
 
-    event = get_object_or_404(Event, pk=request.session.get("payment_paypal_oauth_event"))
-    event.settings.payment_paypal_connect_user_id = request.GET.get("merchantId")
-    event.settings.payment_paypal_merchant_id = request.GET.get("merchantIdInPayPal")
+    event = get_object_or_404(Event, pk=request.session["payment_paypal_oauth_event"])
+    event.settings.payment_paypal_connect_user_id = request.GET["merchantId"]
+    event.settings.payment_paypal_merchant_id = request.GET["merchantIdInPayPal"]
 
     messages.success(
         request,
@@ -107,10 +122,8 @@ def success(request, *args, **kwargs):
     if "cart_namespace" in kwargs:
         urlkwargs["cart_namespace"] = kwargs["cart_namespace"]
 
-    if request.session.get("payment_paypal_payment"):
-        payment = OrderPayment.objects.get(
-            pk=request.session.get("payment_paypal_payment")
-        )
+    if payment_pk := request.session.get("payment_paypal_payment"):
+        payment = OrderPayment.objects.get(pk=payment_pk)
     else:
         payment = None
 
@@ -155,10 +168,8 @@ def success(request, *args, **kwargs):
 def abort(request, *args, **kwargs):
     messages.error(request, _("It looks like you canceled the PayPal payment"))
 
-    if request.session.get("payment_paypal_payment"):
-        payment = OrderPayment.objects.get(
-            pk=request.session.get("payment_paypal_payment")
-        )
+    if payment_pk := request.session.get("payment_paypal_payment"):
+        payment = OrderPayment.objects.get(pk=payment_pk)
     else:
         payment = None
 
@@ -190,17 +201,16 @@ def check_webhook_signature(request, event, event_json, prov) -> bool:
     :return: True if the signature is valid, False otherwise
     """
 
-    required_headers = [
-        "PAYPAL-AUTH-ALGO",
-        "PAYPAL-CERT-URL",
-        "PAYPAL-TRANSMISSION-ID",
-        "PAYPAL-TRANSMISSION-SIG",
-        "PAYPAL-TRANSMISSION-TIME",
-    ]
-    if any(header not in request.headers for header in required_headers):
+    if not request.META.keys() >= _REQUIRED_WEBHOOK_HEADERS:
         logger.error("Paypal webhook missing required headers")
         return False
 
+    if not prov.paypal_request_handler.is_paypal_cert_url(
+        request.headers.get("PAYPAL-CERT-URL")
+    ):
+        logger.error("Paypal webhook certificate url is not served by Paypal.")
+        return False
+
     # Prevent replay attacks: check timestamp
     current_time = datetime.now(timezone.utc)
     transmission_time = datetime.fromisoformat(
@@ -219,117 +229,23 @@ def check_webhook_signature(request, event, event_json, prov) -> bool:
             "transmission_time": request.headers.get("PAYPAL-TRANSMISSION-TIME"),
             "webhook_id": event.settings.payment_paypal_webhook_id,
             "webhook_event": event_json,
-        }
+        },
+        # PayPal signed the exact bytes it sent, not our re-serialized payload
+        body=request.body,
     )
 
+    if errors := verify_response.get("errors"):
+        logger.error("Unable to verify signature of webhook: %s", errors["reason"])
+        return False
     if (
-        verify_response.get("errors")
-        or safe_get(verify_response, ["response", "verification_status"], "")
+        safe_get(verify_response, ("response", "verification_status"), "")
         == "FAILURE"
     ):
-        errors = verify_response.get("errors")
-        logger.error("Unable to verify signature of webhook: %s", errors["reason"])
+        logger.error("Paypal webhook signature is invalid.")
         return False
     return True
 
 
-def parse_webhook_event(request, event_json):
-    """
-    Parse the given webhook event and return the corresponding event, payment ID and RPO.
-
-    :param request: The current request object
-    :param event_json: The json payload of the webhook
-    :return: A tuple of (event, payment_id, referenced_paypal_object)
-    """
-    event = None
-    payment_id = None
-    if event_json["resource_type"] == "refund":
-        for link in event_json["resource"]["links"]:
-            if link["rel"] == "up":
-                refund_url = link["href"]
-                payment_id = refund_url.split("/")[-1]
-                break
-    else:
-        payment_id = event_json["resource"]["id"]
-
-    references = [payment_id]
-
-    # For filtering reference, there are a lot of ids appear within json__event
-    if ref_order_id := (
-        safe_get(
-            event_json,
-            ["resource", "supplementary_data", "related_ids", "order_id"]
-        )
-    ):
-        references.append(ref_order_id)
-
-    # Grasp the corresponding RPO
-    rpo = (
-        ReferencedPayPalObject.objects.select_related("order", "order__event")
-        .filter(reference__in=references)
-        .first()
-    )
-
-    if rpo:
-        event = rpo.order.event
-        if "id" in rpo.payment.info_data:
-            payment_id = rpo.payment.info_data["id"]
-    elif hasattr(request, "event"):
-        event = request.event
-
-    return event, payment_id, rpo
-
-
-def extract_order_and_payment(payment_id, event, event_json, prov, rpo=None):
-    """
-    Extracts order details and associated payment information from PayPal webhook data.
-
-    :param payment_id: The ID of the payment to be extracted.
-    :param event: The event object associated with the payment.
-    :param event_json: The JSON payload of the webhook event.
-    :param prov: The payment provider instance.
-    :param rpo: Optional. The referenced PayPal object containing order and payment information.
-
-    :returns: A tuple containing the order details and the payment object.
-              Returns (None, None) if an error occurs while retrieving order details.
-    """
-    order_detail = None
-    payment = None
-
-    order_response = prov.paypal_request_handler.get_order(order_id=payment_id)
-    if errors := order_response.get("errors"):
-        logger.error("Paypal error on webhook: %s", errors["reason"])
-        logger.exception("PayPal error on webhook. Event data: %s", str(event_json))
-        return order_detail, payment
-
-    order_detail = order_response.get("response")
-
-    if rpo and rpo.payment:
-        payment = rpo.payment
-    else:
-        payments = OrderPayment.objects.filter(
-            order__event=event, provider="paypal", info__icontains=order_detail.get("id")
-        )
-        payment = None
-        for p in payments:
-            if (
-                "info_data" in p
-                and "purchase_units" in p.info_data
-                and p.info_data["purchase_units"]
-            ):
-                for capture in safe_get(
-                    p.info_data["purchase_units"][0], ["payments", "captures"], []
-                ):
-                    if capture.get("status") in [
-                        "COMPLETED",
-                        "PARTIALLY_REFUNDED",
-                    ] and capture.get("id") == order_detail.get("id"):
-                        payment = p
-                        break
-
-    return order_detail, payment
-
-
 @csrf_exempt
 @require_POST
 @scopes_disabled()
@@ -338,147 +254,42 @@ def webhook(request, *args, **kwargs):
     https://developer.paypal.com/api/rest/webhooks/event-names/
     Webhook reference
     """
-    event_body = request.body.decode("utf-8").strip()
-    event_json = json.loads(event_body)
+    # Reject oversized or non-JSON payloads before the body is read and parsed
+    try:
+        content_length = int(request.headers.get("Content-Length") or 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid Content-Length")
+    if content_length > _MAX_WEBHOOK_BODY_SIZE:
+        return HttpResponse(status=HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    if not request.content_type.startswith("application/json"):
+        return HttpResponse(status=HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+    try:
+        event_json = orjson.loads(request.body)
+    except orjson.JSONDecodeError:
+        return HttpResponseBadRequest("Invalid JSON")
+    if not isinstance(event_json, dict):
+        return HttpResponseBadRequest("Invalid JSON")
 
     if event_json.get("resource_type") not in ("checkout-order", "refund", "capture"):
-        return HttpResponse("Wrong resource type", status=HTTPStatus.BAD_REQUEST)
+        return HttpResponseBadRequest("Wrong resource type")
 
-    event, payment_id, rpo = parse_webhook_event(request, event_json)
+    event, payment_id, rpo = parse_webhook_event(
+        event_json, getattr(request, "event", None)
+    )
     if event is None:
-        return HttpResponse("Unable to get event from webhook", status=HTTPStatus.BAD_REQUEST)
+        return HttpResponseBadRequest("Unable to get event from webhook")
 
     prov = Paypal(event)
 
     # Verify signature
     if not check_webhook_signature(request, event, event_json, prov):
-        return HttpResponse("Unable to verify signature of webhook", status=HTTPStatus.BAD_REQUEST)
+        return HttpResponseBadRequest("Unable to verify signature of webhook")
 
-    order_detail, payment = extract_order_and_payment(
-        payment_id, event, event_json, prov, rpo
+    process_paypal_webhook.apply_async(
+        args=(event.pk, event_json, payment_id, rpo.payment_id if rpo else None),
+        queue=get_webhook_queue(),
     )
-    if order_detail is None or payment is None:
-        return HttpResponse("Order or payment not found", status=HTTPStatus.BAD_REQUEST)
-
-    payment.order.log_action("pretix.plugins.eventyay_paypal.event", data=event_json)
-
-    def handle_refund():
-        refund_id_in_event = safe_get(event_json, ["resource", "id"])
-        refund_response = prov.paypal_request_handler.get_refund_detail(
-            refund_id=refund_id_in_event,
-            merchant_id=event.settings.payment_paypal_merchant_id,
-        )
-        if errors := refund_response.get("errors"):
-            logger.error("Paypal error on webhook: %s", errors["reason"])
-            logger.exception("PayPal error on webhook. Event data: %s", str(event_json))
-            return HttpResponse(
-                f'Refund {refund_id_in_event} not found', status=HTTPStatus.BAD_REQUEST
-            )
-
-        refund_detail = refund_response.get("response")
-        if refund_id := refund_detail.get("id"):
-            known_refunds = {
-                refund.info_data.get("id"): refund for refund in payment.refunds.all()
-            }
-            if refund_id not in known_refunds:
-                payment.create_external_refund(
-                    amount=abs(
-                        Decimal(safe_get(refund_detail, ["amount", "value"], "0.00"))
-                    ),
-                    info=json.dumps(refund_detail),
-                )
-            elif know_refund := known_refunds.get(refund_id):
-                if (
-                    know_refund.state
-                    in (
-                        OrderRefund.REFUND_STATE_CREATED,
-                        OrderRefund.REFUND_STATE_TRANSIT,
-                    )
-                    and refund_detail.get("status", "") == "COMPLETED"
-                ):
-                    know_refund.done()
-
-            seller_payable_breakdown_value = safe_get(
-                refund_detail,
-                ["seller_payable_breakdown", "total_refunded_amount", "value"],
-                "0.00",
-            )
-            known_sum = payment.refunds.filter(
-                state__in=(
-                    OrderRefund.REFUND_STATE_DONE,
-                    OrderRefund.REFUND_STATE_TRANSIT,
-                    OrderRefund.REFUND_STATE_CREATED,
-                    OrderRefund.REFUND_SOURCE_EXTERNAL,
-                )
-            ).aggregate(s=Sum("amount"))["s"] or Decimal("0.00")
-            total_refunded_amount = Decimal(seller_payable_breakdown_value)
-            if known_sum < total_refunded_amount:
-                payment.create_external_refund(amount=total_refunded_amount - known_sum)
-
-    def handle_payment_state_confirmed():
-        if event_json.get("resource_type") == "refund":
-            handle_refund()
-        elif order_detail.get("status") == "REFUNDED":
-            known_sum = payment.refunds.filter(
-                state__in=(
-                    OrderRefund.REFUND_STATE_DONE,
-                    OrderRefund.REFUND_STATE_TRANSIT,
-                    OrderRefund.REFUND_STATE_CREATED,
-                    OrderRefund.REFUND_SOURCE_EXTERNAL,
-                )
-            ).aggregate(s=Sum("amount"))["s"] or Decimal("0.00")
-            if known_sum < payment.amount:
-                payment.create_external_refund(amount=payment.amount - known_sum)
-
-    def handle_payment_state_pending():
-        if order_detail.get("status") == "APPROVED":
-            try:
-                request.session["payment_paypal_order_id"] = payment.info_data.get("id")
-                payment.payment_provider.execute_payment(request, payment)
-            except PaymentException as e:
-                logger.error(
-                    "Error executing approved payment in webhook: payment not yet populated."
-                )
-                logger.exception("Unable to execute payment in webhook: %s", str(e))
-        elif order_detail.get("status") == "COMPLETED":
-            captured = False
-            captures_completed = True
-            for purchase_unit in order_detail.get("purchase_units", []):
-                for capture in safe_get(purchase_unit, ["payment", "captures"], []):
-                    with contextlib.suppress(
-                        ReferencedPayPalObject.MultipleObjectsReturned
-                    ):
-                        ReferencedPayPalObject.objects.get_or_create(
-                            order=payment.order,
-                            payment=payment,
-                            reference=capture.get("id"),
-                        )
-                    if capture.get("status") in (
-                        "COMPLETED",
-                        "REFUNDED",
-                        "PARTIALLY_REFUNDED",
-                    ):
-                        captured = True
-                    else:
-                        captures_completed = False
-            if captured and captures_completed:
-                with contextlib.suppress(Quota.QuotaExceededException):
-                    payment.info = json.dumps(order_detail)
-                    payment.save(update_fields=["info"])
-                    payment.confirm()
-
-    if payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED and order_detail[
-        "status"
-    ] in ("PARTIALLY_REFUNDED", "REFUNDED", "COMPLETED"):
-        handle_payment_state_confirmed()
-    elif payment.state in (
-        OrderPayment.PAYMENT_STATE_PENDING,
-        OrderPayment.PAYMENT_STATE_CREATED,
-        OrderPayment.PAYMENT_STATE_CANCELED,
-        OrderPayment.PAYMENT_STATE_FAILED,
-    ):
-        handle_payment_state_pending()
-
     return HttpResponse(status=HTTPStatus.OK)
 
 
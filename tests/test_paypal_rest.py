@@ -0,0 +1,149 @@
+import base64
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+
+from eventyay_paypal.paypal_rest import PaypalRequestHandler
+
+CERT_URL = "https://api.paypal.com/v1/notifications/certs/CERT-360caa42"
+BODY = b'{"id": "WH-1", "resource_type": "checkout-order"}'
+
+
+def make_certificate(common_name, issuer_key=None, issuer_name=None, ca=False):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    current_time = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(issuer_name or name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(current_time - timedelta(days=1))
+        .not_valid_after(current_time + timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+        .sign(issuer_key or key, hashes.SHA256())
+    )
+    return key, certificate
+
+
+def pem(*certificates):
+    return b"".join(c.public_bytes(serialization.Encoding.PEM) for c in certificates)
+
+
+@pytest.fixture
+def pki():
+    root_key, root = make_certificate("Test Root CA", ca=True)
+    intermediate_key, intermediate = make_certificate(
+        "Test Intermediate CA", root_key, root.subject, ca=True
+    )
+    leaf_key, leaf = make_certificate(
+        "messageverificationcerts.paypal.com", intermediate_key, intermediate.subject
+    )
+    return {
+        "root": root,
+        "intermediate": intermediate,
+        "intermediate_key": intermediate_key,
+        "leaf": leaf,
+        "leaf_key": leaf_key,
+    }
+
+
+@pytest.fixture
+def handler(monkeypatch, pki):
+    monkeypatch.setattr(
+        PaypalRequestHandler, "get_trusted_roots", classmethod(lambda cls: [pki["root"]])
+    )
+    return PaypalRequestHandler.__new__(PaypalRequestHandler)
+
+
+def serve(monkeypatch, handler, bundle):
+    monkeypatch.setattr(handler, "get_webhook_certificate", lambda cert_url: bundle)
+
+
+def signed_data(key, body=BODY):
+    message = f"tid|2026-10-14T00:00:00Z|WH-ID|{zlib.crc32(body)}".encode()
+    signature = key.sign(message, padding.PKCS1v15(), hashes.SHA256())
+    return {
+        "auth_algo": "SHA256withRSA",
+        "cert_url": CERT_URL,
+        "transmission_id": "tid",
+        "transmission_sig": base64.b64encode(signature).decode(),
+        "transmission_time": "2026-10-14T00:00:00Z",
+        "webhook_id": "WH-ID",
+    }
+
+
+def test_valid_signature(monkeypatch, handler, pki):
+    serve(monkeypatch, handler, pem(pki["leaf"], pki["intermediate"]))
+    data = signed_data(pki["leaf_key"])
+    assert handler.verify_webhook_signature_locally(data, BODY) == "SUCCESS"
+
+
+def test_modified_body(monkeypatch, handler, pki):
+    serve(monkeypatch, handler, pem(pki["leaf"], pki["intermediate"]))
+    data = signed_data(pki["leaf_key"])
+    assert handler.verify_webhook_signature_locally(data, BODY + b" ") == "FAILURE"
+
+
+def test_invalid_signature_encoding(monkeypatch, handler, pki):
+    serve(monkeypatch, handler, pem(pki["leaf"], pki["intermediate"]))
+    data = dict(signed_data(pki["leaf_key"]), transmission_sig="not base64!")
+    assert handler.verify_webhook_signature_locally(data, BODY) == "FAILURE"
+
+
+def test_unexpected_subject(monkeypatch, handler, pki):
+    key, certificate = make_certificate(
+        "www.paypal.com", pki["intermediate_key"], pki["intermediate"].subject
+    )
+    serve(monkeypatch, handler, pem(certificate, pki["intermediate"]))
+    assert handler.verify_webhook_signature_locally(signed_data(key), BODY) is None
+
+
+def test_missing_intermediate(monkeypatch, handler, pki):
+    serve(monkeypatch, handler, pem(pki["leaf"]))
+    data = signed_data(pki["leaf_key"])
+    assert handler.verify_webhook_signature_locally(data, BODY) is None
+
+
+def test_issued_by_non_ca(monkeypatch, handler, pki):
+    key, leaf = make_certificate(
+        "messageverificationcerts.paypal.com", pki["leaf_key"], pki["leaf"].subject
+    )
+    serve(monkeypatch, handler, pem(leaf, pki["leaf"], pki["intermediate"]))
+    assert handler.verify_webhook_signature_locally(signed_data(key), BODY) is None
+
+
+def test_self_signed_certificate(monkeypatch, handler):
+    key, certificate = make_certificate("messageverificationcerts.paypal.com")
+    serve(monkeypatch, handler, pem(certificate))
+    assert handler.verify_webhook_signature_locally(signed_data(key), BODY) is None
+
+
+def test_untrusted_root(monkeypatch, handler, pki):
+    other_root_key, other_root = make_certificate("Test Root CA", ca=True)
+    intermediate_key, intermediate = make_certificate(
+        "Test Intermediate CA", other_root_key, other_root.subject, ca=True
+    )
+    key, leaf = make_certificate(
+        "messageverificationcerts.paypal.com", intermediate_key, intermediate.subject
+    )
+    serve(monkeypatch, handler, pem(leaf, intermediate))
+    assert handler.verify_webhook_signature_locally(signed_data(key), BODY) is None
+
+
+def test_unavailable_certificate_falls_back(monkeypatch, handler, pki):
+    serve(monkeypatch, handler, None)
+    data = signed_data(pki["leaf_key"])
+    assert handler.verify_webhook_signature_locally(data, BODY) is None
+
+
+def test_trusted_roots_from_ca_bundle():
+    roots = PaypalRequestHandler.get_trusted_roots()
+    assert roots
+    assert all(isinstance(root, x509.Certificate) for root in roots)